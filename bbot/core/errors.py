@@ -55,3 +55,7 @@ class DNSError(BBOTError):
 
 class CurlError(BBOTError):
     pass
+
+
+class SudoAuthError(BBOTError):
+    pass
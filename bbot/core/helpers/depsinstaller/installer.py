@@ -2,17 +2,20 @@ import os
 import sys
 import stat
 import json
+import fcntl
 import shutil
 import getpass
 import logging
+import tempfile
+import subprocess
 from time import sleep
 from pathlib import Path
 from itertools import chain
-from contextlib import suppress
-from ansible_runner.interface import run
+from contextlib import suppress, contextmanager
 from subprocess import CalledProcessError
 
 from bbot.core import configurator
+from bbot.core.errors import SudoAuthError
 from bbot.modules import module_loader
 from ..misc import can_sudo_without_password, os_platform
 
@@ -36,9 +39,10 @@ class DepsInstaller:
                 self._sudo_password = ""
         self.data_dir = self.parent_helper.cache_dir / "depsinstaller"
         self.parent_helper.mkdir(self.data_dir)
-        self.setup_status_cache = self.data_dir / "setup_status.json"
+        self.setup_status_cache = self.data_dir / "setup_status.jsonl"
         self.command_status = self.data_dir / "command_status"
         self.parent_helper.mkdir(self.command_status)
+        self.completed_commands = self.read_command_status()
         self.setup_status = self.read_setup_status()
 
         self.no_deps = self.parent_helper.config.get("no_deps", False)
@@ -49,15 +53,30 @@ class DepsInstaller:
         self.venv = ""
         if sys.prefix != sys.base_prefix:
             self.venv = sys.prefix
+        # take into consideration whether the venv, bbot home directory, or hostname changes
+        self.deps_salt = self.venv + str(self.parent_helper.bbot_home) + os.uname()[1]
 
         self.all_modules_preloaded = module_loader.preloaded()
 
+        # only the minimal facts (os_family, system, etc.) are needed by module tasks
+        self.gather_subset = ["!all"]
+        self.ansible_envvars = {
+            # don't re-execute the python interpreter for every task
+            "ANSIBLE_PIPELINING": "True",
+            # gather facts once per run instead of once per play
+            "ANSIBLE_GATHERING": "smart",
+        }
+
     def install(self, *modules):
         self.install_core_deps()
         succeeded = []
         failed = []
+        # module hashes whose setup status needs saving
+        updated = []
         try:
             notified = False
+            # modules whose dependencies need installing: {module_name: module_hash}
+            to_install = {}
             for m in modules:
                 # assume success if we're ignoring dependencies
                 if self.no_deps:
@@ -69,14 +88,8 @@ class DepsInstaller:
                     failed.append(m)
                     continue
                 preloaded = self.all_modules_preloaded[m]
-                # make a hash of the dependencies and check if it's already been handled
-                # take into consideration whether the venv or bbot home directory changes
-                module_hash = self.parent_helper.sha1(
-                    json.dumps(preloaded["deps"], sort_keys=True)
-                    + self.venv
-                    + str(self.parent_helper.bbot_home)
-                    + os.uname()[1]
-                ).hexdigest()
+                # check if the module's dependencies have already been handled
+                module_hash = self.parent_helper.sha1(preloaded["deps_hash"] + self.deps_salt).hexdigest()
                 success = self.setup_status.get(module_hash, None)
                 dependencies = list(chain(*preloaded["deps"].values()))
                 if len(dependencies) <= 0:
@@ -92,14 +105,7 @@ class DepsInstaller:
                         # get sudo access if we need it
                         if preloaded.get("sudo", False) == True:
                             self.ensure_root(f'Module "{m}" needs root privileges to install its dependencies.')
-                        success = self.install_module(m)
-                        self.setup_status[module_hash] = success
-                        if success or self.ignore_failed_deps:
-                            log.debug(f'Setup succeeded for module "{m}"')
-                            succeeded.append(m)
-                        else:
-                            log.warning(f'Setup failed for module "{m}"')
-                            failed.append(m)
+                        to_install[m] = module_hash
                     else:
                         if success or self.ignore_failed_deps:
                             log.debug(
@@ -112,38 +118,130 @@ class DepsInstaller:
                             )
                             failed.append(m)
 
+            if to_install:
+                results = self.install_modules(list(to_install))
+                for m, success in results.items():
+                    self.setup_status[to_install[m]] = success
+                    updated.append(to_install[m])
+                    if success or self.ignore_failed_deps:
+                        log.debug(f'Setup succeeded for module "{m}"')
+                        succeeded.append(m)
+                    else:
+                        log.warning(f'Setup failed for module "{m}"')
+                        failed.append(m)
+
         finally:
-            self.write_setup_status()
+            if updated:
+                self.write_setup_status(updated)
 
         succeeded.sort()
         failed.sort()
         return succeeded, failed
 
-    def install_module(self, module):
-        success = True
-        preloaded = self.all_modules_preloaded[module]
+    def install_modules(self, modules):
+        """
+        Install dependencies for several modules in one go
+
+        OS and pip packages are merged into a single install each, and every module's
+        shell commands and Ansible tasks are combined into one playbook (one play per module)
+        so that ansible-runner is only started once.
+
+        Returns a dictionary of {module_name: success}
+        """
+        results = {m: True for m in modules}
+        preloaded = {m: self.all_modules_preloaded[m] for m in modules}
 
         # apt
-        deps_apt = preloaded["deps"]["apt"]
+        deps_apt = list(dict.fromkeys(chain(*[p["deps"]["apt"] for p in preloaded.values()])))
         if deps_apt:
             self.apt_install(deps_apt)
 
         # pip
-        deps_pip = preloaded["deps"]["pip"]
+        deps_pip = {m: p["deps"]["pip"] for m, p in preloaded.items() if p["deps"]["pip"]}
         if deps_pip:
-            success &= self.pip_install(deps_pip)
+            if not self.pip_install(list(dict.fromkeys(chain(*deps_pip.values())))):
+                # retry one module at a time so we know which one is to blame
+                for m, packages in deps_pip.items():
+                    results[m] &= self.pip_install(packages)
+
+        # shell + ansible tasks
+        plays = []
+        for m in modules:
+            tasks = self.install_module(m)
+            if tasks:
+                plays.append(
+                    {
+                        "name": m,
+                        "hosts": "all",
+                        "gather_subset": self.gather_subset,
+                        "tasks": [
+                            {
+                                "block": self.fix_tasks(tasks),
+                                # keep going with the other modules if this one fails
+                                "rescue": [
+                                    {
+                                        "name": f"{m}.deps failed",
+                                        "ansible.builtin.debug": {"msg": f'Setup failed for module "{m}"'},
+                                    }
+                                ],
+                            }
+                        ],
+                    }
+                )
+        if plays:
+            log.info(f"Running shell and Ansible dependencies for {len(plays):,} modules")
+            log.debug(json.dumps(plays, indent=2))
+            status, rc, events = self._ansible_run(playbook=plays)
+            failed = self.failed_plays(events)
+            if status != "successful":
+                log.warning(f"Failed to run Ansible dependencies (status: {status}, return code: {rc})")
+                if failed:
+                    failed.update(p["name"] for p in plays)
+                else:
+                    # nothing ran (e.g. one module's tasks couldn't be parsed), so don't blame every module for it
+                    log.verbose("Retrying Ansible dependencies one module at a time")
+                    for play in plays:
+                        status, rc, events = self._ansible_run(playbook=[play])
+                        if status != "successful":
+                            failed.add(play["name"])
+                        failed.update(self.failed_plays(events))
+            for m in failed:
+                if m in results:
+                    results[m] = False
+
+        return results
+
+    def failed_plays(self, events):
+        """
+        Returns the names of the plays with failed Ansible tasks
+        """
+        failed = set()
+        for e in events:
+            if e["event"] == "runner_on_failed":
+                event_data = e["event_data"]
+                if event_data.get("ignore_errors", False):
+                    continue
+                m = event_data.get("play", "")
+                log.warning(f'Failed to run Ansible task for module "{m}": {event_data["res"].get("msg", "")}')
+                failed.add(m)
+        return failed
+
+    def install_module(self, module):
+        """
+        Returns the Ansible tasks (shell commands + custom tasks) for a module's dependencies
+        """
+        tasks = []
+        preloaded = self.all_modules_preloaded[module]
 
         # shell
         deps_shell = preloaded["deps"]["shell"]
         if deps_shell:
-            success &= self.shell(module, deps_shell)
+            tasks += self.shell_tasks(module, deps_shell)
 
         # ansible tasks
-        ansible_tasks = preloaded["deps"]["ansible"]
-        if ansible_tasks:
-            success &= self.tasks(module, ansible_tasks)
+        tasks += preloaded["deps"]["ansible"]
 
-        return success
+        return tasks
 
     def pip_install(self, packages):
         packages_str = ",".join(packages)
@@ -169,17 +267,20 @@ class DepsInstaller:
         """
         packages_str = ",".join(packages)
         log.info(f"Installing the following OS packages: {packages_str}")
-        args = {"name": packages_str, "state": "present"}  # , "update_cache": True, "cache_valid_time": 86400}
-        kwargs = {}
-        # don't sudo brew
-        if os_platform() != "darwin":
-            kwargs = {
-                "ansible_args": {
-                    "ansible_become": True,
-                    "ansible_become_method": "sudo",
+        if self.parent_helper.which("apt-get"):
+            success, err = self.apt_get_install(packages)
+        else:
+            args = {"name": list(packages), "state": "present", "update_cache": True}
+            kwargs = {}
+            # don't sudo brew
+            if os_platform() != "darwin":
+                kwargs = {
+                    "ansible_args": {
+                        "ansible_become": True,
+                        "ansible_become_method": "sudo",
+                    }
                 }
-            }
-        success, err = self.ansible_run(module="package", args=args, **kwargs)
+            success, err = self.ansible_run(module="package", args=args, **kwargs)
         if success:
             log.info(f'Successfully installed OS packages "{packages_str}"')
         else:
@@ -190,13 +291,57 @@ class DepsInstaller:
                 log.warning(f" - {p}")
         return success
 
+    def apt_get_install(self, packages):
+        """
+        Install packages by calling apt-get directly, without the overhead of ansible-runner
+
+        The package lists are only refreshed if the first attempt fails
+        """
+        env = dict(os.environ)
+        env["DEBIAN_FRONTEND"] = "noninteractive"
+        sudo = os.geteuid() != 0
+        # wait for the dpkg lock like ansible's apt module does, e.g. if unattended-upgrades is running
+        lock_timeout = ["-o", "DPkg::Lock::Timeout=60"]
+        command = ["apt-get", "install", "-y"] + lock_timeout + list(packages)
+        # the first attempt is expected to fail if the package lists are stale, so keep it quiet
+        process = self.parent_helper.run(command, sudo=sudo, env=env, stderr=subprocess.DEVNULL)
+        if process is not None and process.returncode != 0:
+            log.verbose("Updating package lists")
+            self.parent_helper.run(["apt-get", "update"] + lock_timeout, sudo=sudo, env=env)
+            process = self.parent_helper.run(command, sudo=sudo, env=env)
+        if process is None:
+            return False, "failed to execute apt-get"
+        err = process.stderr.strip() if process.stderr else ""
+        return process.returncode == 0, err
+
     def shell(self, module, commands):
+        tasks = self.shell_tasks(module, commands)
+        if not tasks:
+            log.debug(f"All {len(commands):,} shell commands for {module} have already been run")
+            return True
+        success, err = self.ansible_run(tasks=tasks)
+        if success:
+            log.info(f"Successfully ran {len(commands):,} shell commands")
+        else:
+            log.warning(f"Failed to run shell dependencies")
+        return success
+
+    def shell_tasks(self, module, commands):
+        """
+        Returns Ansible tasks for a module's shell commands, minus the ones that have already completed
+        """
         tasks = []
         for i, command in enumerate(commands):
             command_hash = self.parent_helper.sha1(f"{module}_{i}_{command}").hexdigest()
+            # skip it here instead of leaving it to Ansible, so we don't start ansible-runner for nothing
+            if command_hash in self.completed_commands:
+                continue
             command_status_file = self.command_status / command_hash
             if type(command) == str:
                 command = {"cmd": command}
+            else:
+                # don't modify the preloaded command
+                command = dict(command)
             command["cmd"] += f" && touch {command_status_file}"
             tasks.append(
                 {
@@ -205,12 +350,7 @@ class DepsInstaller:
                     "args": {"executable": "/bin/bash", "creates": str(command_status_file)},
                 }
             )
-        success, err = self.ansible_run(tasks=tasks)
-        if success:
-            log.info(f"Successfully ran {len(commands):,} shell commands")
-        else:
-            log.warning(f"Failed to run shell dependencies")
-        return success
+        return tasks
 
     def tasks(self, module, tasks):
         log.info(f"Running {len(tasks):,} Ansible tasks for {module}")
@@ -222,51 +362,18 @@ class DepsInstaller:
         return success
 
     def ansible_run(self, tasks=None, module=None, args=None, ansible_args=None):
-        _ansible_args = {"ansible_connection": "local"}
-        if ansible_args is not None:
-            _ansible_args.update(ansible_args)
-        module_args = None
-        if args:
-            module_args = " ".join([f'{k}="{v}"' for k, v in args.items()])
         log.debug(f"ansible_run(module={module}, args={args}, ansible_args={ansible_args})")
-        playbook = None
-        if tasks:
-            for task in tasks:
-                if "package" in task:
-                    # special case for macos
-                    if os_platform() == "darwin":
-                        # don't sudo brew
-                        task["become"] = False
-                        # brew doesn't support update_cache
-                        task["package"].pop("update_cache", "")
-            playbook = {"hosts": "all", "tasks": tasks}
-            log.debug(json.dumps(playbook, indent=2))
-        if self._sudo_password is not None:
-            _ansible_args["ansible_become_password"] = self._sudo_password
-        playbook_hash = self.parent_helper.sha1(str(playbook)).hexdigest()
-        data_dir = self.data_dir / (module if module else f"playbook_{playbook_hash}")
-        shutil.rmtree(data_dir, ignore_errors=True)
-        self.parent_helper.mkdir(data_dir)
+        if module:
+            # run single modules as a task so that their args (e.g. lists of packages) are passed natively
+            tasks = [{"name": module, module: dict(args or {})}]
+        playbook = {"hosts": "all", "gather_subset": self.gather_subset, "tasks": self.fix_tasks(tasks)}
+        log.debug(json.dumps(playbook, indent=2))
 
-        res = run(
-            playbook=playbook,
-            private_data_dir=str(data_dir),
-            host_pattern="localhost",
-            inventory={
-                "all": {"hosts": {"localhost": _ansible_args}},
-            },
-            module=module,
-            module_args=module_args,
-            quiet=not self.ansible_debug,
-            verbosity=(3 if self.ansible_debug else 0),
-            cancel_callback=lambda: None,
-        )
+        status, rc, events = self._ansible_run(playbook=playbook, ansible_args=ansible_args, name=module)
 
-        log.debug(f"Ansible status: {res.status}")
-        log.debug(f"Ansible return code: {res.rc}")
-        success = res.status == "successful"
+        success = status == "successful"
         err = ""
-        for e in res.events:
+        for e in events:
             # if self.ansible_debug and not success:
             #    log.debug(json.dumps(e, indent=4))
             if e["event"] == "runner_on_failed":
@@ -274,23 +381,137 @@ class DepsInstaller:
                 break
         return success, err
 
+    def _ansible_run(self, playbook, ansible_args=None, name=None):
+        """
+        Execute a playbook with ansible-runner, and return its (status, return code, events)
+        """
+        _ansible_args = {"ansible_connection": "local"}
+        if ansible_args is not None:
+            _ansible_args.update(ansible_args)
+        if self._sudo_password is not None:
+            _ansible_args["ansible_become_password"] = self._sudo_password
+        # reuse the same data dir across runs, and let ansible-runner prune old artifacts
+        data_dir = self.data_dir / (name if name else "playbook")
+        self.parent_helper.mkdir(data_dir)
+
+        # ansible-runner is slow to import, so only load it when it's needed
+        from ansible_runner.interface import run
+
+        # the data dir is shared with other bbot processes, so hold the lock until we've read our events
+        with self.lock("ansible"):
+            res = run(
+                playbook=playbook,
+                private_data_dir=str(data_dir),
+                host_pattern="localhost",
+                inventory={
+                    "all": {"hosts": {"localhost": _ansible_args}},
+                },
+                quiet=not self.ansible_debug,
+                verbosity=(3 if self.ansible_debug else 0),
+                cancel_callback=lambda: None,
+                envvars=self.ansible_envvars,
+                rotate_artifacts=1,
+            )
+            events = list(res.events)
+
+        log.debug(f"Ansible status: {res.status}")
+        log.debug(f"Ansible return code: {res.rc}")
+        # shell commands may have completed
+        self.completed_commands = self.read_command_status()
+        return res.status, res.rc, events
+
+    @contextmanager
+    def lock(self, name):
+        """
+        Hold an exclusive lock (shared across processes) on the named lock file in the data dir
+        """
+        with open(self.data_dir / f"{name}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def fix_tasks(self, tasks):
+        for task in tasks:
+            if "package" in task:
+                # special case for macos
+                if os_platform() == "darwin":
+                    # don't sudo brew
+                    task["become"] = False
+                    # brew doesn't support update_cache
+                    task["package"].pop("update_cache", "")
+        return tasks
+
+    def read_command_status(self):
+        """
+        Returns the set of hashes of shell commands that have completed successfully
+        """
+        return {e.name for e in os.scandir(self.command_status)}
+
     def read_setup_status(self):
+        """
+        Read the setup status log, in which each line is a {"hash": ..., "success": ...} record
+
+        Later records override earlier ones for the same module hash
+        """
         setup_status = dict()
+        num_lines = 0
+        line = "\n"
         if self.setup_status_cache.is_file():
-            with open(self.setup_status_cache) as f:
-                with suppress(Exception):
-                    setup_status = json.load(f)
+            # other bbot processes may be appending to or compacting the log
+            with self.lock("setup_status"):
+                with open(self.setup_status_cache) as f:
+                    for line in f:
+                        num_lines += 1
+                        # skip lines that are corrupt or only partially written
+                        with suppress(Exception):
+                            record = json.loads(line)
+                            setup_status[record["hash"]] = record["success"]
+                # rewrite the log once it's mostly superseded records, or if its last write was cut short
+                if num_lines > 2 * len(setup_status) or not line.endswith("\n"):
+                    self.compact_setup_status(setup_status)
         return setup_status
 
-    def write_setup_status(self):
-        with open(self.setup_status_cache, "w") as f:
-            json.dump(self.setup_status, f)
+    def write_setup_status(self, module_hashes):
+        """
+        Append the current setup status of the given module hashes to the log
+        """
+        with self.lock("setup_status"):
+            if not self.setup_status_cache.is_file():
+                # the log supersedes the old setup_status.json, which is no longer read
+                (self.data_dir / "setup_status.json").unlink(missing_ok=True)
+            with open(self.setup_status_cache, "a") as f:
+                self._write_setup_records(f, {h: self.setup_status[h] for h in module_hashes})
+
+    def compact_setup_status(self, setup_status):
+        """
+        Atomically replace the setup status log with a single record per module hash
+
+        The caller must hold the setup status lock
+        """
+        fd, tmp_file = tempfile.mkstemp(dir=self.data_dir, prefix="setup_status.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                self._write_setup_records(f, setup_status)
+            os.replace(tmp_file, self.setup_status_cache)
+        except BaseException:
+            with suppress(OSError):
+                os.unlink(tmp_file)
+            raise
+
+    def _write_setup_records(self, f, setup_status):
+        for module_hash, success in setup_status.items():
+            f.write(json.dumps({"hash": module_hash, "success": success}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
 
     def ensure_root(self, message=""):
         if os.geteuid() != 0 and self._sudo_password is None:
             if message:
                 log.warning(message)
-            while not self._sudo_password:
+            # same number of tries as sudo itself
+            for _ in range(3):
                 # sleep for a split second to flush previous log messages
                 sleep(0.1)
                 password = getpass.getpass(prompt="[USER] Please enter sudo password: ")
@@ -298,8 +519,11 @@ class DepsInstaller:
                     log.success("Authentication successful")
                     self._sudo_password = password
                     configurator.bbot_sudo_pass = password
-                else:
-                    log.warning("Incorrect password")
+                    # refresh sudo's credential cache so upcoming sudo commands don't need to call the askpass script
+                    self.parent_helper.run(["sudo", "-S", "-v"], input=password)
+                    return
+                log.warning("Incorrect password")
+            raise SudoAuthError("Failed to authenticate with sudo")
 
     def install_core_deps(self):
         to_install = set()
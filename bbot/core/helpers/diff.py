@@ -1,7 +1,5 @@
 import logging
-import xmltodict
 from time import sleep
-from deepdiff import DeepDiff
 from contextlib import suppress
 from xml.parsers.expat import ExpatError
 from bbot.core.errors import HttpCompareError
@@ -44,14 +42,15 @@ class HttpCompare:
         if baseline_1.status_code != baseline_2.status_code:
             log.debug("Status code not stable during baseline, aborting")
             raise HttpCompareError("Can't get baseline from source URL")
-        try:
-            baseline_1_json = xmltodict.parse(baseline_1.text)
-            baseline_2_json = xmltodict.parse(baseline_2.text)
-        except ExpatError:
+        baseline_1_json = self.parse_xml(baseline_1.text)
+        baseline_2_json = self.parse_xml(baseline_2.text)
+        if baseline_1_json is None or baseline_2_json is None:
             log.debug(f"Cant HTML parse for {baseline_url}. Switching to text parsing as a backup")
             baseline_1_json = baseline_1.text.split("\n")
             baseline_2_json = baseline_2.text.split("\n")
 
+        from deepdiff import DeepDiff
+
         ddiff = DeepDiff(baseline_1_json, baseline_2_json, ignore_order=True, view="tree")
         self.ddiff_filters = []
 
@@ -61,8 +60,9 @@ class HttpCompare:
                 self.ddiff_filters.append(x.path())
 
         self.baseline_json = baseline_1_json
+        self.baseline_text = baseline_1.text
 
-        self.baseline_ignore_headers = [
+        self.baseline_ignore_headers = frozenset(
             h.lower()
             for h in [
                 "date",
@@ -72,40 +72,62 @@ class HttpCompare:
                 "X-Pad",
                 "X-Backside-Transport",
             ]
-        ]
+        )
         dynamic_headers = self.compare_headers(baseline_1.headers, baseline_2.headers)
 
-        self.baseline_ignore_headers += [x.lower() for x in dynamic_headers]
+        self.baseline_ignore_headers |= frozenset(dynamic_headers)
         self.baseline_body_distance = self.compare_body(baseline_1_json, baseline_2_json)
 
+    def parse_xml(self, text):
+        """
+        Parse an HTTP response body as XML, returning None if it isn't valid XML
+        """
+        # don't bother with the parser unless the body starts with a tag
+        if text.lstrip("\ufeff \t\r\n").startswith("<"):
+            import xmltodict
+
+            with suppress(ExpatError):
+                return xmltodict.parse(text)
+        return None
+
     def gen_cache_buster(self):
         return {self.parent_helper.rand_string(6): "1"}
 
     def compare_headers(self, headers_1, headers_2):
-        differing_headers = []
-
-        for i, headers in enumerate((headers_1, headers_2)):
-            for header, value in list(headers.items()):
-                if header.lower() in self.baseline_ignore_headers:
-                    with suppress(KeyError):
-                        log.debug(f'found ignored header "{header}" in headers_{i+1} and removed')
-                        del headers[header]
-
-        ddiff = DeepDiff(headers_1, headers_2, ignore_order=True, view="tree")
+        """
+        Returns a list of (lowercase) header names whose presence or value differs between headers_1 and headers_2
+        """
+        headers_1 = self.normalize_headers(headers_1)
+        headers_2 = self.normalize_headers(headers_2)
+        differing_headers = [h for h in headers_1.keys() | headers_2.keys() if headers_1.get(h) != headers_2.get(h)]
+        return sorted(differing_headers)
 
-        for k, v in ddiff.items():
-            for x in list(ddiff[k]):
-                try:
-                    header_value = str(x).split("'")[1]
-                except KeyError:
-                    continue
-                differing_headers.append(header_value)
-        return differing_headers
+    def normalize_headers(self, headers):
+        """
+        Returns a plain dictionary of headers with lowercase names, minus the ones we ignore
+        """
+        normalized = {}
+        for header, value in headers.items():
+            header = header.lower()
+            if header not in self.baseline_ignore_headers:
+                normalized[header] = value
+        return normalized
 
     def compare_body(self, content_1, content_2):
         if content_1 == content_2:
             return True
 
+        # plain text bodies (lists of lines)
+        if type(content_1) == list and type(content_2) == list:
+            # DeepDiff ignores both order and repetition here, so equal sets of lines means no differences
+            if set(content_1) == set(content_2):
+                return True
+            # and if there are no dynamic lines to exclude, any difference is a mismatch
+            if not self.ddiff_filters:
+                return False
+
+        from deepdiff import DeepDiff
+
         ddiff = DeepDiff(content_1, content_2, ignore_order=True, view="tree", exclude_paths=self.ddiff_filters)
 
         if len(ddiff.keys()) == 0:
@@ -128,9 +150,10 @@ class HttpCompare:
 
         reflection = False
         if self.include_cache_buster:
-            cache_key, cache_value = list(self.gen_cache_buster().items())[0]
+            cache_key, cache_value = next(iter(self.gen_cache_buster().items()))
             url = self.parent_helper.add_get_params(subject, {cache_key: cache_value}).geturl()
         else:
+            cache_key = None
             url = subject
         subject_response = self.parent_helper.request(
             url, headers=headers, cookies=cookies, allow_redirects=allow_redirects, method=method
@@ -140,26 +163,29 @@ class HttpCompare:
             # this can be caused by a WAF not liking the header, so we really arent interested in it
             return (True, "403", reflection, subject_response)
 
+        # decode the body only once
+        subject_text = subject_response.text
+
         if check_reflection:
+            values = []
             for arg in (headers, cookies):
                 if arg is not None:
-                    for k, v in arg.items():
-                        if v in subject_response.text:
-                            reflection = True
-                            break
-
-            subject_params = self.parent_helper.get_get_params(subject)
-            for k, v in subject_params.items():
-                if k != cache_key and v in subject_response.text:
-                    reflection = True
-                    break
-
-        try:
-            subject_json = xmltodict.parse(subject_response.text)
-
-        except ExpatError:
-            log.debug(f"Cant HTML parse for {subject.split('?')[0]}. Switching to text parsing as a backup")
-            subject_json = subject_response.text.split("\n")
+                    values.extend(arg.values())
+            # GET parameter values come as lists
+            for k, v in self.parent_helper.get_get_params(subject).items():
+                if k != cache_key:
+                    values.extend(v)
+            reflection = any(v in subject_text for v in values)
+
+        # skip parsing and diffing the body if it's identical to the baseline
+        body_match = subject_text == self.baseline_text
+        if not body_match:
+            subject_json = self.parse_xml(subject_text)
+            if subject_json is None:
+                log.debug(f"Cant HTML parse for {subject.split('?')[0]}. Switching to text parsing as a backup")
+                subject_json = subject_text.split("\n")
+
+            body_match = self.compare_body(self.baseline_json, subject_json)
 
         diff_reasons = []
 
@@ -174,7 +200,7 @@ class HttpCompare:
             log.debug(f"headers were different, no match [{different_headers}]")
             diff_reasons.append("header")
 
-        if self.compare_body(self.baseline_json, subject_json) == False:
+        if body_match == False:
             log.debug(f"difference in HTML body, no match")
 
             diff_reasons.append("body")
@@ -69,6 +69,9 @@ class ModuleLoader:
         if self._preloaded_orig is None:
             self._preloaded_orig = dict(self._preloaded)
         self._preloaded = search_format_dict(self._preloaded_orig, **kwargs)
+        # the dependencies may have changed, so their hashes need updating
+        for preloaded in self._preloaded.values():
+            preloaded["deps_hash"] = self.deps_hash(preloaded["deps"])
 
     def check_type(self, module, type):
         return self._preloaded[module]["type"] == type
@@ -158,8 +161,14 @@ class ModuleLoader:
             x == True for x in search_dict_by_key("ansible_become", ansible_tasks)
         ):
             preloaded_data["sudo"] = True
+        # take a hash of the dependencies so we can tell when they've already been installed
+        preloaded_data["deps_hash"] = self.deps_hash(preloaded_data["deps"])
         return preloaded_data
 
+    @staticmethod
+    def deps_hash(deps):
+        return sha1(deps).hexdigest()
+
     def load_modules(self, module_names):
         modules = {}
         for module_name in module_names:
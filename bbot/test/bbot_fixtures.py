@@ -127,6 +127,7 @@ def neograph(monkeypatch, helpers):
 
 @pytest.fixture
 def patch_ansible(monkeypatch):
+    import ansible_runner.interface
     from ansible_runner.interface import run
 
     class AnsibleRunnerResult:
@@ -142,7 +143,7 @@ def patch_ansible(monkeypatch):
     ensure_root = installer.DepsInstaller.ensure_root
 
     def patch_scan_ansible(scanner):
-        monkeypatch.setattr(installer, "run", ansible_run)
+        monkeypatch.setattr(ansible_runner.interface, "run", ansible_run)
         monkeypatch.setattr(scanner.helpers.depsinstaller, "ensure_root", lambda *args, **kwargs: None)
         return run, ensure_root
 
@@ -15,6 +15,26 @@ def test_depsinstaller(monkeypatch, bbot_config, bbot_scanner):
     assert test_file.is_file()
     test_file.unlink(missing_ok=True)
 
+    # completed shell commands shouldn't start ansible-runner
+    import ansible_runner.interface
+
+    def ansible_run(*args, **kwargs):
+        raise AssertionError("ansible-runner shouldn't run for completed shell commands")
+
+    with monkeypatch.context() as m:
+        m.setattr(ansible_runner.interface, "run", ansible_run)
+        assert scan.helpers.depsinstaller.shell(module="plumbus", commands=[f"touch {test_file}"]) == True
+        assert scan.helpers.depsinstaller.shell_tasks(module="plumbus", commands=[f"touch {test_file}"]) == []
+    assert not test_file.exists()
+
+    # newly completed shell commands are picked up without reloading the depsinstaller
+    command = f"touch {test_file}.2"
+    command_hash = scan.helpers.sha1(f"plumbus_0_{command}").hexdigest()
+    assert command_hash not in scan.helpers.depsinstaller.completed_commands
+    assert scan.helpers.depsinstaller.shell(module="plumbus", commands=[command]) == True
+    assert command_hash in scan.helpers.depsinstaller.completed_commands
+    Path(f"{test_file}.2").unlink(missing_ok=True)
+
     # test tasks
     scan.helpers.depsinstaller.tasks(
         module="plumbus",
@@ -22,3 +42,109 @@ def test_depsinstaller(monkeypatch, bbot_config, bbot_scanner):
     )
     assert test_file.is_file()
     test_file.unlink(missing_ok=True)
+
+    # test batched install
+    def preloaded(shell):
+        return {"deps": {"pip": [], "apt": [], "shell": shell, "ansible": []}, "sudo": False}
+
+    monkeypatch.setitem(
+        scan.helpers.depsinstaller.all_modules_preloaded, "plumbus1", preloaded([f"touch {test_file}"])
+    )
+    monkeypatch.setitem(scan.helpers.depsinstaller.all_modules_preloaded, "plumbus2", preloaded(["false"]))
+    results = scan.helpers.depsinstaller.install_modules(["plumbus1", "plumbus2"])
+    assert results == {"plumbus1": True, "plumbus2": False}
+    assert test_file.is_file()
+    test_file.unlink(missing_ok=True)
+
+    # a module whose tasks can't be parsed shouldn't take the rest of the batch down with it
+    monkeypatch.setitem(scan.helpers.depsinstaller.all_modules_preloaded, "plumbus3", preloaded(["true"]))
+    bad_module = preloaded([])
+    bad_module["deps"]["ansible"] = [{"name": "bad task", "plumbus.nonexistent.action": {}}]
+    monkeypatch.setitem(scan.helpers.depsinstaller.all_modules_preloaded, "plumbus4", bad_module)
+    results = scan.helpers.depsinstaller.install_modules(["plumbus3", "plumbus4"])
+    assert results == {"plumbus3": True, "plumbus4": False}
+
+    # test setup status log
+    depsinstaller = scan.helpers.depsinstaller
+    depsinstaller.setup_status["plumbus_hash"] = False
+    depsinstaller.write_setup_status(["plumbus_hash"])
+    depsinstaller.setup_status["plumbus_hash"] = True
+    depsinstaller.write_setup_status(["plumbus_hash"])
+    assert depsinstaller.read_setup_status()["plumbus_hash"] == True
+
+    # superseded records, corrupt lines and a torn last write are compacted away
+    with open(depsinstaller.setup_status_cache, "w") as f:
+        f.write('{"hash": "plumbus_a", "success": false}\n')
+        f.write('{"hash": "plumbus_a", "success": true}\n')
+        f.write("plumbus\n")
+        f.write('{"hash": "plumbus_b", "success": false}\n')
+        f.write('{"hash": "plumbus_b", "success": true}\n')
+        f.write('{"hash": "plumbus_c", "succ')
+    assert depsinstaller.read_setup_status() == {"plumbus_a": True, "plumbus_b": True}
+    assert depsinstaller.setup_status_cache.read_text() == (
+        '{"hash": "plumbus_a", "success": true}\n{"hash": "plumbus_b", "success": true}\n'
+    )
+    assert not list(depsinstaller.data_dir.glob("*.tmp"))
+
+    # the old setup status file is removed when the log is first created
+    legacy_setup_status = depsinstaller.data_dir / "setup_status.json"
+    legacy_setup_status.write_text("{}")
+    depsinstaller.setup_status_cache.unlink()
+    depsinstaller.write_setup_status(["plumbus_hash"])
+    assert not legacy_setup_status.exists()
+    assert depsinstaller.read_setup_status() == {"plumbus_hash": True}
+
+    # test apt-get install: fail -> update package lists -> retry
+    import subprocess
+
+    commands = []
+    returncodes = [100, 0, 0]
+
+    def run(command, *args, **kwargs):
+        commands.append((command, kwargs.get("stderr", None)))
+        return subprocess.CompletedProcess(command, returncodes.pop(0), stdout="", stderr="")
+
+    monkeypatch.setattr(depsinstaller.parent_helper, "run", run)
+    assert depsinstaller.apt_get_install(["plumbus"]) == (True, "")
+    assert [c[0][:2] for c in commands] == [["apt-get", "install"], ["apt-get", "update"], ["apt-get", "install"]]
+    assert all("DPkg::Lock::Timeout=60" in c[0] for c in commands)
+    # only the first attempt is silenced
+    assert commands[0][1] == subprocess.DEVNULL
+    assert commands[2][1] is None
+
+    # test sudo password prompt
+    import getpass
+    from bbot.core import configurator
+    from bbot.core.errors import SudoAuthError
+
+    prompts = []
+    sudo_commands = []
+
+    def getpass_(*args, **kwargs):
+        prompts.append(kwargs.get("prompt", ""))
+        return "plumbus"
+
+    def run(command, *args, **kwargs):
+        sudo_commands.append((command, kwargs.get("input", None)))
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "geteuid", lambda: 1000)
+        m.setattr(getpass, "getpass", getpass_)
+        m.setattr(configurator, "bbot_sudo_pass", None)
+        m.setattr(depsinstaller, "_sudo_password", None)
+        m.setattr(depsinstaller.parent_helper, "run", run)
+
+        # give up after three wrong passwords, like sudo does
+        m.setattr(depsinstaller.parent_helper, "verify_sudo_password", lambda password: False)
+        with pytest.raises(SudoAuthError):
+            depsinstaller.ensure_root()
+        assert len(prompts) == 3
+        assert depsinstaller._sudo_password is None
+        assert sudo_commands == []
+
+        prompts.clear()
+        m.setattr(depsinstaller.parent_helper, "verify_sudo_password", lambda password: password == "plumbus")
+        depsinstaller.ensure_root()
+        assert len(prompts) == 1
+        assert depsinstaller._sudo_password == "plumbus"
+        assert sudo_commands == [(["sudo", "-S", "-v"], "plumbus")]
@@ -54,7 +54,14 @@ def test_helpers(helpers, scan, bbot_scanner, bbot_config, bbot_httpserver):
         compare_helper.compare("http://www.example.com", headers={"asdf": "asdf"})
         compare_helper.compare("http://www.example.com", cookies={"asdf": "asdf"})
         compare_helper.compare("http://www.example.com", check_reflection=True)
+        compare_helper.compare("http://www.example.com?wat=wat", check_reflection=True)
         compare_helper.compare_body({"asdf": "fdsa"}, {"fdsa": "asdf"})
+        assert compare_helper.compare_body(["a", "b"], ["b", "a", "a"]) == True
+        assert compare_helper.compare_body(["a", "b"], ["a", "c"]) == False
+        assert compare_helper.compare_headers({"A": "1", "Date": "x", "C": "3"}, {"a": "2", "b": "2", "c": "3"}) == [
+            "a",
+            "b",
+        ]
         for mode in ("getparam", "header", "cookie"):
             compare_helper.canary_check("http://www.example.com", mode=mode) == True
 